@@ -3,7 +3,7 @@ ivt_analysis.py
 Run: python ivt_analysis.py --sheet_url "<google_sheet_url>" --output_dir ./output
 
 Requirements:
-pip install pandas numpy matplotlib openpyxl xlsxwriter jinja2
+pip install pandas pyarrow numpy numba matplotlib tsdownsample openpyxl xlsxwriter
 Optional (to produce PDF): pip install pdfkit  and install wkhtmltopdf, OR use headless chrome via playwright.
 
 Notes:
@@ -17,10 +17,23 @@ import argparse
 from urllib.parse import urlparse, parse_qs
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # charts are only written to files, no interactive backend needed
 import matplotlib.pyplot as plt
 from matplotlib.dates import DateFormatter
+from matplotlib.figure import Figure
+from tsdownsample import LTTBDownsampler
 import io
-from jinja2 import Template
+from concurrent.futures import ProcessPoolExecutor
+from math import sqrt
+from numba import njit
+
+# the charts are small dashboard thumbnails: simplify paths, keep raster resolution modest and use fixed
+# margins (room for the rotated date labels) instead of running tight_layout on every chart
+plt.rcParams.update({'path.simplify': True, 'path.simplify_threshold': 1.0, 'agg.path.chunksize': 10000,
+                     'savefig.dpi': 100, 'figure.autolayout': False,
+                     'figure.subplot.left': 0.06, 'figure.subplot.right': 0.98,
+                     'figure.subplot.bottom': 0.38, 'figure.subplot.top': 0.9})
 
 # ---------- Helpers ----------
 def sheet_csv_export_url(sheet_url, gid=None):
@@ -37,11 +50,35 @@ def sheet_csv_export_url(sheet_url, gid=None):
     gid_arg = gid if gid is not None else 0
     return f"https://docs.google.com/spreadsheets/d/{sheet_id}/export?format=csv&gid={gid_arg}"
 
+def default_header_names(columns):
+    """
+    Name blank and duplicate headers the way pandas' default CSV parser does
+    ('Unnamed: N', 'x', 'x.1', ...); the pyarrow engine leaves them as-is.
+    """
+    names = [f'Unnamed: {i}' if c is None or str(c).strip() == '' else c for i, c in enumerate(columns)]
+    header = set(names)
+    counts = {}
+    for i, old_col in enumerate(names):
+        col = old_col
+        cur_count = counts.get(col, 0)
+        while cur_count > 0:
+            counts[old_col] = cur_count + 1
+            col = f'{old_col}.{cur_count}'
+            # skip suffixes that are already taken by another header
+            cur_count = cur_count + 1 if col in header else counts.get(col, 0)
+        names[i] = col
+        counts[col] = cur_count + 1
+    return names
+
 def load_csv_url(url):
-    # pandas can read remote URL if publicly accessible.
-    return pd.read_csv(url)
+    # pandas can read remote URL if publicly accessible; the pyarrow engine parses with multiple threads.
+    df = pd.read_csv(url, engine='pyarrow')
+    df.columns = default_header_names(df.columns)
+    return df
 
 # ---------- Analysis functions ----------
+SPIKE_METRICS = ['idfa_ua_ratio','requests_per_idfa','impressions_per_idfa','idfa_ip_ratio']
+
 def preprocess(df):
     # lower-case column names and strip spaces
     df = df.rename(columns=lambda c: c.strip())
@@ -52,33 +89,167 @@ def preprocess(df):
     else:
         # try first column
         df['Date'] = pd.to_datetime(df.iloc[:,0], errors='coerce')
+    # integer timestamps, computed once: cheap to sort on and what LTTB wants as x.
+    # NaT maps to int64 max so unparseable dates still sort last, as sort_values('Date') did
+    df['_ts'] = np.where(df['Date'].isna(), np.iinfo(np.int64).max, df['Date'].values.view('int64'))
     # numeric conversion for common columns
     numcols = ['unique_idfas','unique_ips','unique_uas','total_requests',
                'requests_per_idfa','impressions','impressions_per_idfa',
                'idfa_ip_ratio','idfa_ua_ratio','IVT']
-    for c in numcols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors='coerce')
+    existing = [c for c in numcols if c in df.columns]
+    # The frame keeps full precision and its missing values (it is exported as raw_data);
+    # only the block handed to the rolling kernel is zero-filled and cast to float32.
+    df[existing] = df[existing].apply(pd.to_numeric, errors='coerce')
     return df
 
-def detect_spikes(series, window=24, z_thresh=3.0):
-    rol_mean = series.rolling(window=window, min_periods=1).mean()
-    rol_std = series.rolling(window=window, min_periods=1).std().replace(0,np.nan)
-    z = (series - rol_mean) / rol_std
-    return (z.abs() > z_thresh).fillna(False), z
+@njit(cache=True, error_model='numpy')
+def rolling_z(x, w, gid):
+    """
+    Single-pass rolling z-score (window w, min_periods=1, ddof=1) down each column of x,
+    restarting wherever gid changes. As in pandas rolling, non-finite values are left out of
+    the window statistics, and the result is NaN where the std is 0/undefined.
+    """
+    n, k = x.shape
+    z = np.empty((n, k), dtype=x.dtype)
+    buf = np.empty((w, k), dtype=x.dtype)
+    nv = np.zeros(k, dtype=np.int64)  # finite values currently in the window
+    mean = np.zeros(k, dtype=np.float64)
+    m2 = np.zeros(k, dtype=np.float64)
+    # last finite value and how many times in a row it was seen, to recognise constant windows exactly
+    last = np.zeros(k, dtype=np.float64)
+    same = np.zeros(k, dtype=np.int64)
+    start = 0
+    for i in range(n):
+        if i > 0 and gid[i] != gid[i - 1]:
+            start = i
+            nv[:] = 0
+            mean[:] = 0.0
+            m2[:] = 0.0
+            same[:] = 0
+        r = i - start
+        pos = r % w
+        for j in range(k):
+            if r >= w:
+                old = buf[pos, j]
+                if np.isfinite(old):
+                    nv[j] -= 1
+                    if nv[j] == 0:
+                        mean[j] = 0.0
+                        m2[j] = 0.0
+                    else:
+                        delta = old - mean[j]
+                        mean[j] -= delta / nv[j]
+                        m2[j] -= delta * (old - mean[j])
+            xi = x[i, j]
+            buf[pos, j] = xi
+            if np.isfinite(xi):
+                nv[j] += 1
+                delta = xi - mean[j]
+                mean[j] += delta / nv[j]
+                m2[j] += delta * (xi - mean[j])
+                same[j] = same[j] + 1 if xi == last[j] else 1
+                last[j] = xi
+            if nv[j] > 1 and same[j] < nv[j] and m2[j] > 0.0:
+                z[i, j] = (xi - mean[j]) / sqrt(m2[j] / (nv[j] - 1))
+            else:
+                z[i, j] = np.nan
+    return z
+
+def detect_spikes(values, window=24, z_thresh=3.0, groups=None):
+    # accepts a single series or an (n, k) block of metrics; all columns are rolled in one pass.
+    # groups: optional per-row group ids (rows of a group must be contiguous), windows restart per group
+    x = np.asarray(values, dtype=np.float32)
+    gid = np.zeros(len(x), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    z = rolling_z(x if x.ndim == 2 else x[:, None], window, gid).reshape(x.shape)
+    return np.abs(z) > z_thresh, z
+
+# a 10in-wide chart can't show more distinct x positions than this; longer series are LTTB-downsampled
+PLOT_MAX_POINTS = 1200
+
+def downsample_positions(df, xcol, ycol, n_out=PLOT_MAX_POINTS, keep_idx=None, tscol=None):
+    """
+    Row positions of df to draw: all plottable rows if there are at most n_out,
+    otherwise an LTTB selection of n_out rows plus the rows in keep_idx (index labels).
+    tscol names a precomputed int64 copy of xcol, if there is one.
+    """
+    pos = np.flatnonzero(df[xcol].notna().to_numpy() & df[ycol].notna().to_numpy())
+    if len(pos) <= n_out:
+        return pos
+    x = df[tscol].to_numpy()[pos] if tscol else df[xcol].to_numpy()[pos].view('int64')
+    x = np.ascontiguousarray(x)
+    y = np.ascontiguousarray(df[ycol].to_numpy()[pos])
+    pos = pos[LTTBDownsampler().downsample(x, y, n_out=n_out)]
+    if keep_idx is not None and len(keep_idx):
+        pos = np.union1d(pos, df.index.get_indexer(keep_idx))
+    return pos
+
+DATE_FORMATTER = DateFormatter("%Y-%m-%d %H:%M")
 
-def make_timeplot(df, xcol, ycol, outpath, title=None, highlight_idx=None):
-    plt.figure(figsize=(10,3))
-    plt.plot(df[xcol], df[ycol], marker='.', linewidth=0.8)
+def make_timeplot(df, xcol, ycol, outpath, title=None, highlight_idx=None, ax=None, tscol=None):
+    # pass ax to draw on (and clear) an existing axes instead of allocating a new figure per chart.
+    # The PNG is encoded once in memory, written to outpath and returned as a BytesIO for embedding.
+    own_fig = ax is None
+    if own_fig:
+        fig, ax = plt.subplots(figsize=(10,3))
+    else:
+        fig = ax.figure
+        ax.cla()
+    pts = df.iloc[downsample_positions(df, xcol, ycol, keep_idx=highlight_idx, tscol=tscol)]
+    ax.plot(pts[xcol], pts[ycol], marker='.', linewidth=0.8)
     if highlight_idx is not None and len(highlight_idx):
-        plt.scatter(df.loc[highlight_idx, xcol], df.loc[highlight_idx, ycol], color='red', s=20)
-    plt.title(title or ycol)
-    plt.xlabel('Date')
-    plt.tight_layout()
-    plt.gca().xaxis.set_major_formatter(DateFormatter("%Y-%m-%d %H:%M"))
-    plt.xticks(rotation=30)
-    plt.savefig(outpath, dpi=150)
-    plt.close()
+        ax.scatter(df.loc[highlight_idx, xcol], df.loc[highlight_idx, ycol], color='red', s=20)
+    ax.set_title(title or ycol)
+    ax.set_xlabel('Date')
+    ax.xaxis.set_major_formatter(DATE_FORMATTER)
+    ax.tick_params(axis='x', labelrotation=30)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    if own_fig:
+        plt.close(fig)
+    with open(outpath, 'wb') as f:
+        f.write(buf.getvalue())
+    buf.seek(0)
+    return buf
+
+# only the first few charts are embedded in the dashboard sheet (15 rows apart); the rest stay on disk
+DASHBOARD_CHARTS = 3
+
+# below this many charts they are rendered inline, a process pool costs more to start than it saves
+POOL_MIN_CHARTS = 24
+
+_worker_ax = None
+
+def _render_one(job):
+    # runs in a pool worker (or inline); each process keeps one figure and reuses it for all its charts
+    global _worker_ax
+    if _worker_ax is None:
+        # a bare Figure, not tracked by pyplot, so the inline path leaves no open figure behind for the caller
+        _worker_ax = Figure(figsize=(10,3)).subplots()
+    df_chart, ycol, outpath, title, highlight_idx, keep_png = job
+    buf = make_timeplot(df_chart, 'Date', ycol, outpath, title=title, highlight_idx=highlight_idx,
+                        ax=_worker_ax, tscol='_ts')
+    # only ship the PNG bytes back when the dashboard will embed this chart
+    return buf.getvalue() if keep_png else None
+
+def _cell(v):
+    # what to_excel did for values xlsxwriter can't store as-is: repr containers, write inf as text
+    if isinstance(v, (dict, list)):
+        return str(v)
+    if isinstance(v, (float, np.floating)) and np.isinf(v):
+        return 'inf' if v > 0 else '-inf'
+    return v
+
+def write_frame(worksheet, df, block=10000):
+    """
+    Write df (header + rows, no index) strictly in row order, as xlsxwriter's constant_memory
+    mode requires. Rows are converted in blocks so only one block of Python objects exists at a time.
+    """
+    worksheet.write_row(0, 0, [str(c) for c in df.columns])
+    for start in range(0, len(df), block):
+        chunk = df.iloc[start:start + block]
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        for r, row in enumerate(chunk.itertuples(index=False, name=None), start=start + 1):
+            worksheet.write_row(r, 0, [_cell(v) for v in row])
 
 # ---------- Main ----------
 def run_analysis(df, output_dir):
@@ -87,8 +258,6 @@ def run_analysis(df, output_dir):
     os.makedirs(charts_dir, exist_ok=True)
 
     df = preprocess(df)
-    # Basic summary
-    summary = df.describe(include='all').transpose()
 
     # If the sheet contains an 'app' column, group by app. If not, treat entire dataset as single app.
     app_col = None
@@ -96,44 +265,46 @@ def run_analysis(df, output_dir):
         if candidate in df.columns:
             app_col = candidate; break
 
-    apps = df[app_col].unique() if app_col else ['__ALL__']
+    # sort once by (app, Date) so every per-app slice comes out already in time order
+    df = df.sort_values([app_col, '_ts'] if app_col else '_ts', kind='stable').reset_index(drop=True)
+    # one hash pass for row positions per app instead of a boolean scan per app
+    groups = df.groupby(app_col, sort=False).indices if app_col else {'__ALL__': np.arange(len(df))}
     # store per-app results
     report_entries = []
 
-    for app in apps:
-        df_app = df[df[app_col] == app].copy() if app_col else df.copy()
-        df_app = df_app.sort_values('Date').reset_index(drop=True)
+    # compute spikes for key metrics across all apps at once; the kernel restarts its window at each app boundary
+    present = [m for m in SPIKE_METRICS if m in df.columns]
+    gid = df.groupby(app_col, sort=False, dropna=False).ngroup().to_numpy() if app_col else None
+    # missing values are zero-filled only in the kernel input; df keeps its NaNs for corr() and raw_data
+    flags, _ = detect_spikes(df[present].fillna(0).to_numpy(dtype=np.float32), groups=gid)
+    chart_jobs = []
+    chart_paths = []  # in generation order, so the dashboard never has to rescan charts_dir
 
-        # compute spikes for key metrics
-        spikes = {}
-        zscores = {}
-        for metric in ['idfa_ua_ratio','requests_per_idfa','impressions_per_idfa','idfa_ip_ratio']:
-            if metric in df_app.columns:
-                flag, z = detect_spikes(df_app[metric].fillna(0))
-                spikes[metric] = flag
-                zscores[metric] = z
+    for app, idx in groups.items():
+        df_app = df.take(idx).reset_index(drop=True)
 
         # Define suspicious windows: where at least two metrics spike or where impressions_per_idfa is near zero with many requests
-        combined_spike = np.zeros(len(df_app), dtype=bool)
-        for metric, flag in spikes.items():
-            combined_spike = combined_spike | flag.values
+        combined_spike = flags[idx].any(axis=1)
         # additional rule: many requests but zero impressions
-        rule_zero_impr = (df_app.get('impressions',0).fillna(0) == 0) & (df_app.get('total_requests',0).fillna(0) > 1000)
-        suspicious = pd.Series(combined_spike) | rule_zero_impr.fillna(False)
+        rule_zero_impr = False
+        if 'impressions' in df_app.columns and 'total_requests' in df_app.columns:
+            rule_zero_impr = ((df_app['impressions'].fillna(0) == 0) & (df_app['total_requests'] > 1000)).to_numpy()
+        suspicious = pd.Series(combined_spike | rule_zero_impr)
 
         # correlation of IVT vs metrics (if IVT exists)
         corr = {}
         if 'IVT' in df_app.columns:
-            for metric in ['idfa_ua_ratio','requests_per_idfa','impressions_per_idfa','idfa_ip_ratio']:
-                if metric in df_app.columns:
-                    corr[metric] = df_app[metric].corr(df_app['IVT'])
+            # one correlation matrix instead of a pairwise call per metric
+            corr = df_app[present + ['IVT']].corr()['IVT'].drop('IVT').to_dict()
 
-        # Save charts
+        # Queue charts; each job carries only the Date, _ts and metric columns it needs so pickling stays cheap
         for metric in ['idfa_ua_ratio','requests_per_idfa','impressions_per_idfa']:
             if metric in df_app.columns:
                 out = os.path.join(charts_dir, f"{str(app)}_{metric}.png".replace('/','_'))
                 hidx = df_app.index[suspicious.values]
-                make_timeplot(df_app, 'Date', metric, out, title=f"{app} - {metric}", highlight_idx=hidx)
+                chart_jobs.append((df_app[['Date', '_ts', metric]], metric, out, f"{app} - {metric}", hidx,
+                                   len(chart_jobs) < DASHBOARD_CHARTS))
+                chart_paths.append(out)
 
         # Summaries for Excel sheet
         entry = {
@@ -142,46 +313,50 @@ def run_analysis(df, output_dir):
             'suspicious_count': int(suspicious.sum()),
             'suspicious_ratio': float(suspicious.mean()),
             'corr': corr,
-            'top_suspicious_windows': df_app.loc[suspicious].head(20).to_dict('records')
+            # row positions into df / raw_data for the first 20 suspicious rows; df.iloc[...] recovers them
+            'top_suspicious_idx': idx[np.flatnonzero(suspicious.values)[:20]].tolist()
         }
         report_entries.append(entry)
 
-    # Build Excel workbook
-    writer = pd.ExcelWriter(os.path.join(output_dir, "analysis.xlsx"), engine='xlsxwriter')
+    # Render charts in parallel, they are independent and CPU-bound; keep the PNG bytes of the dashboard charts
+    n_workers = min(len(chart_jobs), os.cpu_count() or 1)
+    if len(chart_jobs) < POOL_MIN_CHARTS or n_workers == 1:
+        # not worth a pool: with spawn/forkserver each worker re-imports numba, matplotlib, ...
+        chart_pngs = [_render_one(job) for job in chart_jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as ex:
+            chart_pngs = list(ex.map(_render_one, chart_jobs))
+
+    # Build Excel workbook; constant_memory flushes each row to disk instead of holding the sheet in RAM
+    writer = pd.ExcelWriter(os.path.join(output_dir, "analysis.xlsx"), engine='xlsxwriter',
+                            engine_kwargs={'options': {'constant_memory': True,
+                                                       'default_date_format': 'yyyy-mm-dd hh:mm:ss'}})
+    workbook  = writer.book
     # summary tabs
-    pd.DataFrame(report_entries).to_excel(writer, sheet_name='summary', index=False)
+    write_frame(workbook.add_worksheet('summary'), pd.DataFrame(report_entries))
     # write raw data
-    df.to_excel(writer, sheet_name='raw_data', index=False)
+    write_frame(workbook.add_worksheet('raw_data'), df.drop(columns='_ts'))
     # add charts as images into a dashboard sheet
-    workbook  = writer.book
     dashboard = workbook.add_worksheet('dashboard')
     # insert chart images
-    y = 1
-    for fname in sorted(os.listdir(charts_dir)):
-        path = os.path.join(charts_dir, fname)
-        if y > 40:
-            break
-        dashboard.insert_image(y, 1, path, {'x_scale':0.8,'y_scale':0.8})
-        y += 15
+    for i, (path, png) in enumerate(zip(chart_paths[:DASHBOARD_CHARTS], chart_pngs)):
+        # embed the in-memory PNG instead of reading the file back from disk
+        dashboard.insert_image(1 + 15 * i, 1, path, {'image_data': io.BytesIO(png), 'x_scale':0.8,'y_scale':0.8})
     writer.close()
 
     # produce a simple HTML report
-    html_templ = Template("""
-    <html><head><meta charset="utf-8"><title>IVT Analysis Report</title></head><body>
-    <h1>IVT Analysis Report</h1>
-    <p>Generated: {{when}}</p>
-    <h2>Per-app summary</h2>
-    {% for e in entries %}
-      <h3>{{e.app}}</h3>
-      <ul>
-        <li>Rows: {{e.n_rows}}</li>
-        <li>Suspicious windows: {{e.suspicious_count}} ({{"{:.1%}".format(e.suspicious_ratio)}})</li>
-        <li>Correlations: {{e.corr}}</li>
-      </ul>
-    {% endfor %}
-    </body></html>
-    """)
-    html = html_templ.render(when=pd.Timestamp.now(), entries=report_entries)
+    chunks = ['<html><head><meta charset="utf-8"><title>IVT Analysis Report</title></head><body>\n',
+              '<h1>IVT Analysis Report</h1>\n',
+              f'<p>Generated: {pd.Timestamp.now()}</p>\n',
+              '<h2>Per-app summary</h2>\n']
+    chunks += [f"<h3>{e['app']}</h3>\n"
+               f"<ul>\n"
+               f"  <li>Rows: {e['n_rows']}</li>\n"
+               f"  <li>Suspicious windows: {e['suspicious_count']} ({e['suspicious_ratio']:.1%})</li>\n"
+               f"  <li>Correlations: {e['corr']}</li>\n"
+               f"</ul>\n" for e in report_entries]
+    chunks.append('</body></html>\n')
+    html = ''.join(chunks)
     with open(os.path.join(output_dir,'analysis_report.html'),'w', encoding='utf8') as f:
         f.write(html)
 
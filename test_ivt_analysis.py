@@ -0,0 +1,87 @@
+import ast
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+
+from ivt_analysis import default_header_names, detect_spikes, load_csv_url, run_analysis
+
+
+def reference_spikes(series, window=24, z_thresh=3.0):
+    rol_mean = series.rolling(window=window, min_periods=1).mean()
+    rol_std = series.rolling(window=window, min_periods=1).std().replace(0, np.nan)
+    z = (series - rol_mean) / rol_std
+    return (z.abs() > z_thresh).fillna(False).to_numpy(), z.to_numpy()
+
+
+def test_detect_spikes_matches_pandas_rolling():
+    rng = np.random.default_rng(0)
+    x = pd.Series(rng.gamma(2, 1, 3000)).astype(np.float32).astype(np.float64)
+    x[::97] = 40
+    x[100:160] = 1.0  # constant run
+    x[500:520] = 0.0
+    x[[7, 300, 301, 2000]] = np.inf
+    x[[8, 900]] = -np.inf
+    x[[9, 1200, 1201, 1202]] = np.nan
+    flags, z = detect_spikes(x)
+    ref_flags, ref_z = reference_spikes(x)
+    np.testing.assert_array_equal(flags, ref_flags)
+    np.testing.assert_array_equal(np.isnan(z), np.isnan(ref_z))
+
+
+def test_detect_spikes_restarts_per_group():
+    rng = np.random.default_rng(1)
+    a, b = pd.Series(rng.random(50)), pd.Series(rng.random(30) * 10)
+    flags, z = detect_spikes(np.stack([pd.concat([a, b]).to_numpy()] * 2, axis=1),
+                             window=7, groups=np.repeat([0, 1], [50, 30]))
+    ref = np.concatenate([reference_spikes(a, 7)[1], reference_spikes(b, 7)[1]])
+    np.testing.assert_allclose(z[:, 0], ref, rtol=1e-4, equal_nan=True)
+    np.testing.assert_array_equal(z[:, 0], z[:, 1])
+
+
+def test_zero_impression_rule_needs_both_columns(tmp_path):
+    n = 48
+    df = pd.DataFrame({'Date': pd.date_range('2024-01-01', periods=n, freq='h').astype(str),
+                       'app': 'a', 'total_requests': 5000.0, 'idfa_ua_ratio': 1.0})
+    run_analysis(df, str(tmp_path))
+    summary = pd.read_excel(tmp_path / 'analysis.xlsx', sheet_name='summary')
+    assert summary.loc[0, 'suspicious_count'] == 0
+
+
+def test_missing_metrics_keep_nan_in_corr_and_raw_data(tmp_path):
+    rng = np.random.default_rng(2)
+    n = 120
+    df = pd.DataFrame({'Date': pd.date_range('2024-01-01', periods=n, freq='h').astype(str),
+                       'app': 'a', 'requests_per_idfa': rng.gamma(2, 1, n),
+                       'idfa_ua_ratio': rng.gamma(1, 2, n), 'IVT': rng.integers(0, 2, n).astype(float)})
+    df.loc[rng.choice(n, 20, replace=False), 'requests_per_idfa'] = np.nan
+    df.loc[rng.choice(n, 20, replace=False), 'idfa_ua_ratio'] = np.nan
+    df.loc[rng.choice(n, 10, replace=False), 'IVT'] = np.nan
+    run_analysis(df.copy(), str(tmp_path))
+
+    summary = pd.read_excel(tmp_path / 'analysis.xlsx', sheet_name='summary')
+    corr = ast.literal_eval(summary.loc[0, 'corr'])
+    for metric in ['idfa_ua_ratio', 'requests_per_idfa']:
+        assert corr[metric] == pytest.approx(df[metric].corr(df['IVT']))
+
+    raw = pd.read_excel(tmp_path / 'analysis.xlsx', sheet_name='raw_data')
+    for col in ['requests_per_idfa', 'idfa_ua_ratio', 'IVT']:
+        np.testing.assert_array_equal(raw[col].isna(), df[col].isna())
+
+
+def test_run_analysis_leaves_no_pyplot_figures(tmp_path):
+    n = 48
+    df = pd.DataFrame({'Date': pd.date_range('2024-01-01', periods=n, freq='h').astype(str),
+                       'app': 'a', 'idfa_ua_ratio': np.arange(n, dtype=float)})
+    run_analysis(df, str(tmp_path))
+    assert plt.get_fignums() == []
+
+
+def test_default_header_names_match_pandas_parser(tmp_path):
+    path = tmp_path / 'headers.csv'
+    path.write_text('a,,a,a.1,,b\n1,2,3,4,5,6\n')
+    expected = list(pd.read_csv(path).columns)
+    assert expected == ['a', 'Unnamed: 1', 'a.2', 'a.1', 'Unnamed: 4', 'b']
+    assert default_header_names(['a', '', 'a', 'a.1', '', 'b']) == expected
+    assert list(load_csv_url(str(path)).columns) == expected